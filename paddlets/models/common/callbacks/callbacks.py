@@ -5,37 +5,135 @@
 # Copyright (c) 2022 Baidu.com, Inc. All Rights Reserved
 #
 ################################################################################
+#
+# Performance notes:
+#   Hot path: CallbackContainer.on_batch_end -> History.on_batch_end, called once per batch.
+#   It is bound by python interpreter overhead, not by compute: the cost is method dispatch,
+#   dict lookups, string formatting and the cuda memory stat queries, plus the state dict
+#   snapshot taken by EarlyStopping on each improvement.
+#   Keep optimizing it by caching (module constants, per-event dispatch tuples, templates),
+#   in-place copies and specialized dispatch methods; do not add numpy / simd / gpu code paths.
+#
+################################################################################
 
-from typing import List, Dict, Any, Optional
-import datetime
+from typing import List, Dict, Any, Callable, Optional
+import functools
+import logging
+import math
+import operator
 import time
-import copy
+import weakref
 import paddle
-import numpy as np
 
 from paddlets.logger import Logger
 import paddlets.utils.utils as utils
 
 logger = Logger(__name__)
+# Whether paddle is compiled with cuda never changes at runtime, query it only once.
+_IS_CUDA = paddle.device.is_compiled_with_cuda()
+_max_memory_reserved = paddle.device.cuda.max_memory_reserved
+_max_memory_allocated = paddle.device.cuda.max_memory_allocated
+# Events dispatched by `CallbackContainer` to its callbacks, mapped to the name of the index
+# parameter received before logs, None if the event only receives logs.
+_EVENT_INDEX_NAMES = {
+    "on_epoch_begin": "epoch",
+    "on_epoch_end": "epoch",
+    "on_batch_begin": "batch",
+    "on_batch_end": "batch",
+    "on_train_begin": None,
+    "on_train_end": None,
+}
+_CALLBACK_EVENTS = tuple(_EVENT_INDEX_NAMES)
+# Batch information read by `History.on_batch_end` from the batch logs.
+_BATCH_LOG_KEYS = ("batch_size", "loss", "epoch", "max_epochs", "steps", "lr")
+_get_batch_info = operator.itemgetter(*_BATCH_LOG_KEYS)
+# Templates of the batch log message.
+# `{max_epochs}` is filled once per training run by `History`.
+_BATCH_MSG_FMT = "[Train] [Epoch %s/{max_epochs}], Step: %s, lr: %.6f, loss: %.6f, samples: %s"
+_READER_COST_FMT = ", reader_cost: %.6f sec"
+_BATCH_COST_FMT = ", batch_cost: %.6f sec, ips: %.6f sequences/sec"
+_MEM_KB_FMT = ", max_mem_reserved: %d KB, max_mem_allocated: %d KB"
+_MEM_MB_FMT = ", max_mem_reserved: %d MB, max_mem_allocated: %d MB"
+
+
+def _is_info_enabled() -> bool:
+    """Whether info messages are emitted, used to skip building messages that would be discarded.
+
+    Returns:
+        bool: True if the logger is enabled for the INFO level.
+    """
+    return logger.logger.isEnabledFor(logging.INFO)
+
+
+def _fmt_hms(t: int) -> str:
+    """Format elapsed seconds as `H:MM:SS`.
+
+    Args:
+        t(int): Elapsed time in seconds.
+
+    Returns:
+        str: Formatted elapsed time.
+    """
+    h, r = divmod(t, 3600)
+    m, s = divmod(r, 60)
+    return f"{h}:{m:02d}:{s:02d}"
+
+
+def _weak_trainer(model: "PaddleBaseModel") -> "PaddleBaseModel":
+    """Get a weak proxy of the model, so that callbacks do not form a reference cycle with their trainer.
+
+    Args:
+        model(PaddleBaseModel): A model instance.
+
+    Returns:
+        PaddleBaseModel: A weak proxy of the model instance.
+    """
+    if isinstance(model, weakref.ProxyTypes):
+        return model
+    return weakref.proxy(model)
 
 
 class Callback(object):
     """Abstract base class used to build new callbacks.
 
     Attributes:
-        _trainer(PaddleBaseModel): A model instance.
+        _trainer(PaddleBaseModel): A weak proxy of the model instance.
     """
+    __slots__ = ("_trainer", )
 
     def __init__(self):
         pass
 
+    def __getstate__(self) -> Dict[str, Any]:
+        """Get the state for pickling and copying, `_trainer` is dropped as weak proxies are not picklable.
+
+        Returns:
+            Dict[str, Any]: Attributes of the callback except `_trainer`.
+        """
+        state = dict(getattr(self, "__dict__", {}))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if not name.startswith("__") and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        state.pop("_trainer", None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        """Restore the state from pickling and copying.
+
+        Args:
+            state(Dict[str, Any]): Attributes of the callback.
+        """
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def set_trainer(self, model: "PaddleBaseModel"):
         """Set model instance.
 
         Args:
             model(PaddleBaseModel): A model instance.
         """
-        self._trainer = model
+        self._trainer = _weak_trainer(model)
 
     def on_epoch_begin(self, epoch: int, logs: Optional[Dict[str, Any]]=None):
         """Called at the beginning of each epoch.
@@ -95,15 +193,24 @@ class Callback(object):
 class CallbackContainer(object):
     """Container holding a list of callbacks.
 
+    The `on_*` event methods are generated by `_make_dispatch` below the class.
+
     Args:
-        callbacks(List[Callback]): List of callbacks.
+        callbacks(List[Callback]): List of callbacks. The list is copied, use `append` to add
+            callbacks afterwards.
 
     Attributes:
         _callbacks(List[Callback]): List of callbacks.
+        _on_*_fns(Tuple[Callable, ...]): Bound methods of the callbacks which override the event,
+            callbacks keeping the no-op implementation of `Callback` are skipped.
     """
+    __slots__ = ("_callbacks", "_trainer") + tuple(f"_{event}_fns"
+                                                   for event in _CALLBACK_EVENTS)
 
     def __init__(self, callbacks: List[Callback]):
-        self._callbacks = callbacks
+        # copied so that the cached dispatch tuples can not go stale behind the container's back
+        self._callbacks = list(callbacks)
+        self._update_dispatch()
 
     def append(self, callback: Callback):
         """Append callback to the container.
@@ -112,82 +219,93 @@ class CallbackContainer(object):
             callback(Callback): Callback instance.
         """
         self._callbacks.append(callback)
+        self._update_dispatch()
 
-    def set_trainer(self, model: "PaddleBaseModel"):
-        """Set model instance.
+    def __getstate__(self) -> Dict[str, Any]:
+        """Get the state for pickling and copying.
 
-        Args:
-            model(PaddleBaseModel): A model instance.
+        `_trainer` is dropped like in `Callback`, as copying a weak proxy copies the whole trainer,
+        and the dispatch tuples are rebuilt from the callbacks on restore.
+
+        Returns:
+            Dict[str, Any]: The callbacks of the container.
         """
-        self._trainer = model
-        for callback in self._callbacks:
-            callback.set_trainer(model)
+        return {"_callbacks": self._callbacks}
 
-    def on_epoch_begin(self, epoch: int, logs: Optional[Dict[str, Any]]=None):
-        """Called at the beginning of each epoch.
+    def __setstate__(self, state: Dict[str, Any]):
+        """Restore the state from pickling and copying.
 
         Args:
-            epoch(int): The index of epoch.
-            logs(Dict[str, Any]|None): The logs is a dict or None.
+            state(Dict[str, Any]): The callbacks of the container.
         """
-        logs = logs or {}
-        for callback in self._callbacks:
-            callback.on_epoch_begin(epoch, logs)
+        # copied like in `__init__`, so that shallow copies do not share the list with the original
+        self._callbacks = list(state["_callbacks"])
+        self._update_dispatch()
+
+    def _update_dispatch(self):
+        """Cache the bound methods to be called for each event."""
+        for event in _CALLBACK_EVENTS:
+            base_fn = getattr(Callback, event)
+            # compare the resolved method, so that events overridden per instance are kept
+            fns = (getattr(callback, event) for callback in self._callbacks)
+            setattr(self, f"_{event}_fns", tuple(
+                fn for fn in fns if getattr(fn, "__func__", None) is not base_fn))
 
-    def on_epoch_end(self, epoch: int, logs: Optional[Dict[str, Any]]=None):
-        """Called at the end of each epoch.
+    def set_trainer(self, model: "PaddleBaseModel"):
+        """Set model instance.
 
         Args:
-            epoch(int): The index of epoch.
-            logs(Dict[str, Any]|None): The logs is a dict or None.
-                contains `loss` and `metrics`.
+            model(PaddleBaseModel): A model instance.
         """
-        logs = logs or {}
+        self._trainer = _weak_trainer(model)
         for callback in self._callbacks:
-            callback.on_epoch_end(epoch, logs)
+            callback.set_trainer(model)
 
-    def on_batch_begin(self, batch: int, logs: Optional[Dict[str, Any]]=None):
-        """Called at the beginning of each batch in training.
 
-        Args:
-            batch(int): The index of batch.
-            logs(Dict[str, Any]|None): The logs is a dict or None.
-        """
-        logs = logs or {}
-        for callback in self._callbacks:
-            callback.on_batch_begin(batch, logs)
+def _make_dispatch(event: str, index_name: Optional[str]) -> Callable:
+    """Build the `CallbackContainer` method dispatching an event to the callbacks.
 
-    def on_batch_end(self, batch: int, logs: Optional[Dict[str, Any]]=None):
-        """Called at the end of each batch in training.
+    Args:
+        event(str): Name of the event, e.g. `on_batch_end`.
+        index_name(str|None): Name of the index parameter received before logs, `epoch` or `batch`,
+            None if the event only receives logs.
 
-        Args:
-            batch(int): The index of batch.
-            logs(Dict[str, Any]|None): The logs is a dict or None.
-                contains `loss` and `batch_size`.
-        """
-        logs = logs or {}
-        for callback in self._callbacks:
-            callback.on_batch_end(batch, logs)
+    Returns:
+        Callable: The dispatch method, with the same signature and docstring as the `Callback` method.
+    """
+    get_fns = operator.attrgetter(f"_{event}_fns")
+    if index_name == "epoch":
 
-    def on_train_begin(self, logs: Optional[Dict[str, Any]]=None):
-        """Called at the start of training.
+        def dispatch(self, epoch, logs=None):
+            if logs is None:
+                logs = {}
+            for fn in get_fns(self):
+                fn(epoch, logs)
+    elif index_name == "batch":
 
-        Args:
-            logs(Dict[str, Any]|None): The logs is a dict or None.
-        """
-        logs = logs or {}
-        for callback in self._callbacks:
-            callback.on_train_begin(logs)
+        def dispatch(self, batch, logs=None):
+            if logs is None:
+                logs = {}
+            for fn in get_fns(self):
+                fn(batch, logs)
+    else:
 
-    def on_train_end(self, logs: Optional[Dict[str, Any]]=None):
-        """Called at the end of training.
+        def dispatch(self, logs=None):
+            if logs is None:
+                logs = {}
+            for fn in get_fns(self):
+                fn(logs)
 
-        Args:
-            logs(Dict[str, Any]|None): The logs is a dict or None.
-        """
-        logs = logs or {}
-        for callback in self._callbacks:
-            callback.on_train_end(logs)
+    functools.update_wrapper(dispatch, getattr(Callback, event))
+    # the signature must describe `dispatch` itself, not the wrapped `Callback` method
+    del dispatch.__wrapped__
+    dispatch.__qualname__ = f"CallbackContainer.{event}"
+    return dispatch
+
+
+for _event, _index_name in _EVENT_INDEX_NAMES.items():
+    setattr(CallbackContainer, _event, _make_dispatch(_event, _index_name))
+del _event, _index_name
 
 
 class EarlyStopping(Callback):
@@ -205,13 +323,18 @@ class EarlyStopping(Callback):
     Attributes:
         _early_stopping_metric(str): Early stopping metric name.
         _is_maximize(bool): Whether to maximize or not early_stopping_metric.
+        _sign(float): 1. if early_stopping_metric is maximized else -1., so that improvement is always positive.
         _tol(float): Minimum change in monitored value to qualify as improvement.
         _patience(int): Number of epochs to wait for improvement before terminating.
         _best_epoch(int): Best epoch.
         _stopped_epoch(int): Stopped epoch.
         _best_loss(float): Best loss.
+        _best_weights(Dict[str, paddle.Tensor]|None): Cpu copy of the network weights of the best epoch.
         _wait(int): Number of times that the early_stopping_metric failed to improve.
     """
+    __slots__ = ("_early_stopping_metric", "_is_maximize", "_sign", "_tol",
+                 "_patience", "_best_epoch", "_stopped_epoch", "_best_weights",
+                 "_best_loss", "_wait")
 
     def __init__(self,
                  early_stopping_metric: str,
@@ -221,12 +344,13 @@ class EarlyStopping(Callback):
         super(EarlyStopping, self).__init__()
         self._early_stopping_metric = early_stopping_metric
         self._is_maximize = is_maximize
+        self._sign = 1. if is_maximize else -1.
         self._tol = tol
         self._patience = patience
         self._best_epoch = 0
         self._stopped_epoch = 0
         self._best_weights = None
-        self._best_loss = np.inf
+        self._best_loss = math.inf
         self._wait = 0
         if self._is_maximize:
             self._best_loss = -self._best_loss
@@ -244,12 +368,8 @@ class EarlyStopping(Callback):
             # raise KeyError(f"{self._early_stopping_metric} is not available, choose in {self._trainer._metrics_names}.")
             return
 
-        loss_change = current_loss - self._best_loss
-        max_improved = self._is_maximize and loss_change > self._tol
-        min_improved = (not self._is_maximize) and (-loss_change > self._tol)
-        if max_improved or min_improved:
-            self._best_weights = copy.deepcopy(
-                self._trainer._network.state_dict())
+        if self._sign * (current_loss - self._best_loss) > self._tol:
+            self._save_best_weights()
             self._best_loss = current_loss
             self._best_epoch = epoch
             self._wait = 0
@@ -259,6 +379,22 @@ class EarlyStopping(Callback):
                 self._trainer._stop_training = True
                 self._stopped_epoch = epoch
 
+    def _save_best_weights(self):
+        """Snapshot the current network weights as the best weights.
+
+        The cpu buffers are allocated on the first improvement and then updated in place,
+        which avoids deep copying the whole state dict on every improvement.
+        """
+        state_dict = self._trainer._network.state_dict()
+        if self._best_weights is None:
+            self._best_weights = {
+                k: v.detach().cpu().clone()
+                for k, v in state_dict.items()
+            }
+        else:
+            for k, v in state_dict.items():
+                self._best_weights[k].copy_(v.detach(), True)
+
     def on_train_end(self, logs: Optional[Dict[str, Any]]=None):
         """Called at the end of training.
 
@@ -269,6 +405,8 @@ class EarlyStopping(Callback):
         self._trainer._best_cost = self._best_loss
         if self._best_weights is not None:
             self._trainer._network.set_state_dict(self._best_weights)
+        if not _is_info_enabled():
+            return
         if self._stopped_epoch > 0:
             msg = f"\nEarly stopping occurred at epoch {self._stopped_epoch}"
             msg += (
@@ -298,8 +436,13 @@ class History(Callback):
         _start_time(float): Start time of training.
         _epoch_loss(float): Average loss per epoch.
         _epoch_metrics(Dict[str, Any]): Record all information of metrics of each epoch.
+        _loss_sum(float): Sum of the sample-weighted batch losses of the current epoch.
         _samples_seen(int): Traversed samples.
+        _batch_fmt(str|None): Batch log message template of the current training run, built on the first batch.
     """
+    __slots__ = ("_verbose", "_history", "_start_time", "_epoch_loss",
+                 "_epoch_metrics", "_loss_sum", "_samples_seen",
+                 "_train_run_cost", "_train_reader_cost", "_batch_fmt")
 
     def __init__(self, verbose: int=1):
         super(History, self).__init__()
@@ -314,6 +457,7 @@ class History(Callback):
         self._history = {"loss": [], "lr": []}
         self._start_time = logs["start_time"]
         self._epoch_loss = 0.  # nqa
+        self._batch_fmt = None
 
     def on_epoch_begin(self, epoch: int, logs: Optional[Dict[str, Any]]=None):
         """Called at the beginning of each epoch.
@@ -323,7 +467,8 @@ class History(Callback):
             logs(Dict[str, Any]|None): The logs is a dict or None.
         """
         self._epoch_metrics = {"loss": 0.}  # nqa
-        self._samples_seen = 0.
+        self._loss_sum = 0.
+        self._samples_seen = 0
         self._train_run_cost = 0.
         self._train_reader_cost = 0.
 
@@ -335,7 +480,10 @@ class History(Callback):
             logs(Dict[str, Any]|None): The logs is a dict or None.
                 contains `loss` and `metrics`.
         """
+        self._epoch_loss = self._loss_sum / max(self._samples_seen, 1)
         self._epoch_metrics["loss"] = self._epoch_loss
+        if not _is_info_enabled():
+            return
         msg = f"[Train] [Epoch {epoch:0>3}]"
         for metric_name, metric_value in self._epoch_metrics.items():
             msg += f", {metric_name:<3}: {metric_value:.6f}"
@@ -350,39 +498,40 @@ class History(Callback):
                 contains `loss` and `batch_size`.
         """
         # get batch information
-        batch_size = logs["batch_size"]
-        batch_loss = logs["loss"]
-        epoch = logs["epoch"]
-        max_epochs = logs["max_epochs"]
-        steps = logs["steps"]
-        lr = logs["lr"]
-
-        # update average loss of each epoch
-        self._epoch_loss = (
-            self._samples_seen * self._epoch_loss + batch_size * batch_loss
-        ) / (self._samples_seen + batch_size)
+        batch_size, batch_loss, epoch, max_epochs, steps, lr = _get_batch_info(
+            logs)
+
+        # accumulate loss of each epoch, the average is computed at the end of the epoch
+        self._loss_sum += batch_size * batch_loss
         self._samples_seen += batch_size
 
+        # skip building the log message if it would be discarded anyway
+        if not _is_info_enabled():
+            return
+
         # update log information
-        msg = f"[Train] [Epoch {epoch}/{max_epochs}], Step: {steps}, lr: {lr:.6f}, loss: {batch_loss:.6f}, samples: {batch_size}"
+        batch_fmt = self._batch_fmt
+        if batch_fmt is None:
+            batch_fmt = self._batch_fmt = _BATCH_MSG_FMT.replace(
+                "{max_epochs}", str(max_epochs))
+        parts = [batch_fmt % (epoch, steps, lr, batch_loss, batch_size)]
         reader_cost = logs.get('train_reader_cost', None)
         if reader_cost is not None:
-            msg += f", reader_cost: {reader_cost:.6f} sec"
+            parts.append(_READER_COST_FMT % reader_cost)
         batch_cost = logs.get('train_run_cost', None)
         if batch_cost is not None:
-            ips = batch_size / batch_cost
-            msg += f", batch_cost: {batch_cost:.6f} sec, ips: {ips:.6f} sequences/sec"
-        max_mem_reserved_str = ""
-        max_mem_allocated_str = ""
-        if paddle.device.is_compiled_with_cuda() and utils.print_mem_info:
-            if paddle.device.cuda.max_memory_reserved() / (1024**2) < 1:
-                max_mem_reserved_str = f", max_mem_reserved: {paddle.device.cuda.max_memory_reserved() // 1024} KB"
-                max_mem_allocated_str = f", max_mem_allocated: {paddle.device.cuda.max_memory_allocated() // 1024} KB"
+            parts.append(_BATCH_COST_FMT % (batch_cost, batch_size / batch_cost))
+        # cuda memory stats are only queried every `verbose` steps
+        if (_IS_CUDA and utils.print_mem_info and
+                steps % max(self._verbose, 1) == 0):
+            reserved = _max_memory_reserved()
+            allocated = _max_memory_allocated()
+            if reserved < 1 << 20:
+                parts.append(_MEM_KB_FMT % (reserved // 1024, allocated // 1024))
             else:
-                max_mem_reserved_str = f", max_mem_reserved: {paddle.device.cuda.max_memory_reserved() // (1024 ** 2)} MB"
-                max_mem_allocated_str = f", max_mem_allocated: {paddle.device.cuda.max_memory_allocated() // (1024 ** 2)} MB"
+                parts.append(_MEM_MB_FMT % (reserved // (1024**2),
+                                            allocated // (1024**2)))
 
-        msg += f"{max_mem_reserved_str}{max_mem_allocated_str}"
         total_time = int(time.time() - self._start_time)
-        msg += f" | {str(datetime.timedelta(seconds=total_time)) + 's':<6}"
-        logger.info(msg)
+        parts.append(" | %-6s" % (_fmt_hms(total_time) + "s"))
+        logger.info("".join(parts))
@@ -3,13 +3,36 @@
 
 from unittest import TestCase, mock
 import unittest
+import contextlib
+import copy
+import inspect
+import logging
+import pickle
 import random
 import time
+import weakref
 
 import numpy as np
+import paddle
 
 from paddlets.models.common.callbacks import (CallbackContainer, EarlyStopping,
                                               Callback, History)
+from paddlets.models.common.callbacks import callbacks as callbacks_module
+from paddlets.models.common.callbacks.callbacks import _fmt_hms
+
+
+@contextlib.contextmanager
+def _suppress_info():
+    """Set the callbacks logger to WARNING and patch its `log`, yield the patched `log` mock.
+    """
+    inner_logger = callbacks_module.logger.logger
+    level = inner_logger.level
+    inner_logger.setLevel(logging.WARNING)
+    try:
+        with mock.patch.object(inner_logger, "log") as log:
+            yield log
+    finally:
+        inner_logger.setLevel(level)
 
 
 class CallbackHelper(Callback):
@@ -67,13 +90,26 @@ class TestCallbak(TestCase):
     def test_callback(self):
         """unittest function
         """
-        # case1
+        # case1, the trainer is held through a weak proxy, so the model and its callbacks
+        # do not form a reference cycle and are freed by reference counting alone.
         cbks = CallbackHelper("test")
-        model = mock.Mock(name="model")
+        model = mock.NonCallableMock(name="model")
+        model.callbacks = cbks
         cbks.set_trainer(model)
+        self.assertIsInstance(cbks._trainer, weakref.ProxyType)
         self.assertEqual(cbks._trainer, model)
+        model_ref = weakref.ref(model)
+        del model
+        self.assertIsNone(model_ref())
+        model = mock.Mock(name="model")
+        cbks.set_trainer(model)
 
-        # case2
+        # case2, the trainer is dropped when pickling
+        copied = pickle.loads(pickle.dumps(cbks))
+        self.assertEqual(copied._name, "test")
+        self.assertFalse(hasattr(copied, "_trainer"))
+
+        # case3
         epochs, steps = 2, 5
         logs = {"loss": 50.341673, "acc": 0.00256}
         cbks.on_train_begin(logs)
@@ -107,11 +143,18 @@ class TestCallbackContainer(TestCase):
         cbks.append(cbk2)
         self.assertEqual(cbk2, cbks._callbacks[1])
 
-        # case3
-        model = mock.Mock(name="model")
+        # case3, the container and its callbacks hold the trainer through weak proxies.
+        model = mock.NonCallableMock(name="model")
+        model.callbacks = cbks
         cbks.set_trainer(model)
+        self.assertIsInstance(cbks._trainer, weakref.ProxyType)
+        self.assertEqual(cbks._trainer, model)
         for ckb in cbks._callbacks:
+            self.assertIsInstance(ckb._trainer, weakref.ProxyType)
             self.assertEqual(ckb._trainer, model)
+        model_ref = weakref.ref(model)
+        del model
+        self.assertIsNone(model_ref())
 
         # case4
         epochs, steps = 2, 5
@@ -127,6 +170,71 @@ class TestCallbackContainer(TestCase):
             cbks.on_epoch_end(epoch, logs)
         cbks.on_train_end(logs)
 
+        # case5, only callbacks overriding an event are dispatched, by class or per instance.
+        class BatchEndCallback(Callback):
+            def on_batch_end(self, batch, logs=None):
+                self.calls.append(batch)
+
+        class InstanceCallback(Callback):
+            pass
+
+        noop_cbk = Callback()
+        class_cbk = BatchEndCallback()
+        class_cbk.calls = []
+        instance_cbk = InstanceCallback()
+        instance_cbk.on_batch_end = mock.Mock(name="on_batch_end")
+        callbacks = [noop_cbk, class_cbk]
+        cbks = CallbackContainer(callbacks)
+        cbks.append(instance_cbk)
+        cbks.on_batch_end(3)
+        self.assertEqual(class_cbk.calls, [3])
+        instance_cbk.on_batch_end.assert_called_once_with(3, {})
+        self.assertTrue(all(
+            getattr(fn, "__self__", None) is not noop_cbk
+            for fn in cbks._on_batch_end_fns))
+
+        # case6, the container keeps its own copy of the callbacks list.
+        callbacks.append(CallbackHelper("cbk3"))
+        self.assertEqual(len(cbks._callbacks), 3)
+
+        # case7, events accept the same keyword arguments as `Callback`.
+        recorder = mock.Mock(spec=Callback)
+        cbks = CallbackContainer([recorder])
+        for event in callbacks_module._CALLBACK_EVENTS:
+            self.assertEqual(
+                inspect.signature(getattr(cbks, event)),
+                inspect.signature(getattr(Callback(), event)))
+        cbks.on_epoch_begin(epoch=0, logs={"a": 1})
+        cbks.on_epoch_end(epoch=1, logs={"b": 2})
+        cbks.on_batch_begin(batch=2)
+        cbks.on_batch_end(batch=3, logs={"c": 3})
+        cbks.on_train_begin(logs={"d": 4})
+        cbks.on_train_end(logs=None)
+        recorder.on_epoch_begin.assert_called_once_with(0, {"a": 1})
+        recorder.on_epoch_end.assert_called_once_with(1, {"b": 2})
+        recorder.on_batch_begin.assert_called_once_with(2, {})
+        recorder.on_batch_end.assert_called_once_with(3, {"c": 3})
+        recorder.on_train_begin.assert_called_once_with({"d": 4})
+        recorder.on_train_end.assert_called_once_with({})
+
+        # case8, copies of the container drop the trainer and dispatch to the copied callbacks.
+        cbks = CallbackContainer([BatchEndCallback()])
+        cbks._callbacks[0].calls = []
+        cbks.set_trainer(mock.Mock(name="model"))
+        copied = copy.deepcopy(cbks)
+        self.assertFalse(hasattr(copied, "_trainer"))
+        self.assertFalse(hasattr(copied._callbacks[0], "_trainer"))
+        copied.on_batch_end(1)
+        self.assertEqual(copied._callbacks[0].calls, [1])
+        self.assertEqual(cbks._callbacks[0].calls, [])
+
+        # case9, shallow copies do not share the callbacks list with the original.
+        shallow = copy.copy(cbks)
+        shallow.append(BatchEndCallback())
+        self.assertEqual(len(cbks._callbacks), 1)
+        self.assertEqual(len(cbks._on_batch_end_fns), 1)
+        self.assertEqual(len(shallow._on_batch_end_fns), 2)
+
 
 class TestEarlyStopping(TestCase):
     def setUp(self):
@@ -150,9 +258,9 @@ class TestEarlyStopping(TestCase):
         model = mock.Mock(name="model")
         model._stop_training = False
         model._max_epoch = 3
-        model.network = mock.Mock(name="network")
-        model.network.state_dict = mock.Mock(return_value={})
-        model.network.set_state_dict = mock.Mock(return_value=None)
+        model._network = mock.Mock(name="network")
+        model._network.state_dict = mock.Mock(return_value={})
+        model._network.set_state_dict = mock.Mock(return_value=None)
         earlystopping.set_trainer(model)
 
         epochs, steps = 3, 5
@@ -176,9 +284,9 @@ class TestEarlyStopping(TestCase):
         model = mock.Mock(name="model")
         model._stop_training = False
         model._max_epoch = 3
-        model.network = mock.Mock(name="network")
-        model.network.state_dict = mock.Mock(return_value={})
-        model.network.set_state_dict = mock.Mock(return_value=None)
+        model._network = mock.Mock(name="network")
+        model._network.state_dict = mock.Mock(return_value={})
+        model._network.set_state_dict = mock.Mock(return_value=None)
         earlystopping.set_trainer(model)
 
         epochs, steps = 3, 5
@@ -196,6 +304,85 @@ class TestEarlyStopping(TestCase):
         self.assertEqual(earlystopping._best_epoch, 0)
         self.assertAlmostEqual(earlystopping._best_loss, 0.00156, delta=1e-5)
 
+    def test_early_stopping_best_weights(self):
+        """unittest function
+        """
+        network = paddle.nn.Sequential(
+            paddle.nn.Linear(3, 2), paddle.nn.BatchNorm1D(2))
+        model = mock.Mock(name="model")
+        model._stop_training = False
+        model._max_epochs = 3
+        model._network = network
+        earlystopping = EarlyStopping(
+            early_stopping_metric="val_mse", is_maximize=False, patience=3)
+        earlystopping.set_trainer(model)
+
+        def snapshot(state_dict):
+            return {k: v.numpy().copy() for k, v in state_dict.items()}
+
+        def train_step():
+            # update parameters as well as the batch norm running statistics.
+            network.train()
+            network(paddle.randn([4, 3]))
+            with paddle.no_grad():
+                for param in network.parameters():
+                    param.set_value(param + 1.)
+
+        def assert_state_dict_equal(state_dict, expected):
+            self.assertEqual(set(state_dict.keys()), set(expected.keys()))
+            for k, v in state_dict.items():
+                np.testing.assert_allclose(v.numpy(), expected[k])
+
+        # case1, the first improvement allocates an unaliased copy.
+        earlystopping.on_epoch_end(0, {"val_mse": 3.})
+        best_weights = earlystopping._best_weights
+        expected = snapshot(network.state_dict())
+        assert_state_dict_equal(best_weights, expected)
+        buffers = {k: id(v) for k, v in best_weights.items()}
+        train_step()
+        assert_state_dict_equal(best_weights, expected)
+
+        # case2, later improvements update the same buffers in place.
+        earlystopping.on_epoch_end(1, {"val_mse": 2.})
+        expected = snapshot(network.state_dict())
+        self.assertIs(earlystopping._best_weights, best_weights)
+        self.assertEqual({k: id(v) for k, v in best_weights.items()}, buffers)
+        assert_state_dict_equal(best_weights, expected)
+
+        # case3, epochs without improvement leave the snapshot untouched.
+        train_step()
+        earlystopping.on_epoch_end(2, {"val_mse": 2.5})
+        assert_state_dict_equal(best_weights, expected)
+
+        # case4, the best weights are restored and stay unaliased to the network.
+        earlystopping.on_train_end()
+        self.assertEqual(model._best_epoch, 1)
+        assert_state_dict_equal(network.state_dict(), expected)
+        train_step()
+        assert_state_dict_equal(best_weights, expected)
+
+    def test_early_stopping_info_disabled(self):
+        """unittest function
+        """
+        # the best epoch and weights are still restored when info messages are suppressed.
+        model = mock.Mock(name="model")
+        model._stop_training = False
+        model._network = mock.Mock(name="network")
+        model._network.state_dict = mock.Mock(return_value={})
+        model._network.set_state_dict = mock.Mock(return_value=None)
+        earlystopping = EarlyStopping(
+            early_stopping_metric="val_mse", is_maximize=False, patience=1)
+        earlystopping.set_trainer(model)
+        with _suppress_info() as log:
+            earlystopping.on_epoch_end(0, {"val_mse": 2.})
+            earlystopping.on_epoch_end(1, {"val_mse": 3.})
+            earlystopping.on_train_end()
+        log.assert_not_called()
+        self.assertEqual(model._stop_training, True)
+        self.assertEqual(model._best_epoch, 0)
+        self.assertEqual(model._best_cost, 2.)
+        model._network.set_state_dict.assert_called_once_with({})
+
 
 class TestHistory(TestCase):
     def setUp(self):
@@ -217,13 +404,37 @@ class TestHistory(TestCase):
             history.on_train_begin(logs)
 
             epochs, steps = 3, 5
-            logs = {"loss": 50.341673, "batch_size": 64}
+            logs = {
+                "loss": 50.341673,
+                "batch_size": 64,
+                "epoch": 0,
+                "max_epochs": epochs,
+                "steps": 0,
+                "lr": 1e-1,
+                "train_reader_cost": 0.01,
+                "train_run_cost": 0.02,
+            }
             epoch_logs = {"lr": 1e-1, "mse": 25.3618, "mae": 5.6325}
             for epoch in range(epochs):
                 history.on_epoch_begin(epoch)
-                for batch in range(steps):
-                    logs["loss"] -= random.random() * 0.1
-                    history.on_batch_end(batch, logs)
+                loss_sum, samples_seen = 0., 0
+                with self.assertLogs(
+                        "paddlets.models.common.callbacks.callbacks",
+                        level="INFO") as cm:
+                    for batch in range(steps):
+                        logs["loss"] -= random.random() * 0.1
+                        logs["batch_size"] = 64 - batch
+                        logs["epoch"], logs["steps"] = epoch, batch
+                        loss_sum += logs["batch_size"] * logs["loss"]
+                        samples_seen += logs["batch_size"]
+                        history.on_batch_end(batch, logs)
+                self.assertEqual(len(cm.output), steps)
+                self.assertIn(
+                    f"[Train] [Epoch {epoch}/{epochs}], Step: {steps - 1}, lr: 0.100000, "
+                    f"loss: {logs['loss']:.6f}, samples: {logs['batch_size']}, "
+                    "reader_cost: 0.010000 sec, batch_cost: 0.020000 sec, ips: ",
+                    cm.output[-1])
+                self.assertRegex(cm.output[-1], r" \| 0:00:\d\ds$")
                 epoch_logs["lr"] -= random.random() * 0.1
                 epoch_logs["mse"] -= random.random() * 0.1
                 epoch_logs["mae"] -= random.random() * 0.1
@@ -233,6 +444,94 @@ class TestHistory(TestCase):
                     "mae": epoch_logs["mae"],
                 })
                 history.on_epoch_end(epoch, history._epoch_metrics)
+                self.assertAlmostEqual(history._epoch_metrics["loss"],
+                                       loss_sum / samples_seen)
+
+        # case4, an epoch without batches reports a zero loss.
+        history.on_epoch_begin(epochs)
+        history.on_epoch_end(epochs, history._epoch_metrics)
+        self.assertEqual(history._epoch_metrics["loss"], 0.)
+
+    def test_history_mem_info(self):
+        """unittest function
+        """
+        reserved = mock.Mock(name="max_memory_reserved")
+        allocated = mock.Mock(name="max_memory_allocated")
+        with mock.patch.object(callbacks_module, "_IS_CUDA", True), \
+                mock.patch.object(callbacks_module.utils, "print_mem_info", True), \
+                mock.patch.object(callbacks_module, "_max_memory_reserved", reserved), \
+                mock.patch.object(callbacks_module, "_max_memory_allocated", allocated):
+            history = History(verbose=2)
+            history.on_train_begin({"start_time": time.time()})
+            history.on_epoch_begin(0)
+            # reserved bytes of the even steps, on both sides of the KB / MB threshold.
+            expected = {
+                0: ((1 << 20) - 1, 1 << 19, "1023 KB", "512 KB"),
+                2: (1 << 20, 1 << 19, "1 MB", "0 MB"),
+                4: (3 << 20, 2 << 20, "3 MB", "2 MB"),
+            }
+            for step in range(6):
+                reserved.reset_mock()
+                allocated.reset_mock()
+                if step in expected:
+                    reserved.return_value, allocated.return_value = expected[
+                        step][:2]
+                with self.assertLogs(
+                        "paddlets.models.common.callbacks.callbacks",
+                        level="INFO") as cm:
+                    history.on_batch_end(step, {
+                        "batch_size": 8,
+                        "loss": 1.,
+                        "epoch": 0,
+                        "max_epochs": 1,
+                        "steps": step,
+                        "lr": 1e-3,
+                    })
+                if step in expected:
+                    reserved.assert_called_once_with()
+                    allocated.assert_called_once_with()
+                    reserved_str, allocated_str = expected[step][2:]
+                    self.assertIn(
+                        f", max_mem_reserved: {reserved_str}, "
+                        f"max_mem_allocated: {allocated_str}", cm.output[0])
+                else:
+                    reserved.assert_not_called()
+                    allocated.assert_not_called()
+                    self.assertNotIn("max_mem_", cm.output[0])
+
+    def test_history_info_disabled(self):
+        """unittest function
+        """
+        # the epoch loss is still accumulated when info messages are suppressed.
+        history = History()
+        with _suppress_info() as log:
+            history.on_train_begin({"start_time": time.time()})
+            history.on_epoch_begin(0)
+            for step, (batch_size, loss) in enumerate([(64, 1.5), (32, 0.75)]):
+                history.on_batch_end(step, {
+                    "batch_size": batch_size,
+                    "loss": loss,
+                    "epoch": 0,
+                    "max_epochs": 1,
+                    "steps": step,
+                    "lr": 1e-3,
+                    "train_reader_cost": 0.01,
+                    "train_run_cost": 0.02,
+                })
+            self.assertAlmostEqual(history._loss_sum, 64 * 1.5 + 32 * 0.75)
+            self.assertEqual(history._samples_seen, 96)
+            history.on_epoch_end(0, history._epoch_metrics)
+        log.assert_not_called()
+        self.assertAlmostEqual(history._epoch_metrics["loss"],
+                               (64 * 1.5 + 32 * 0.75) / 96)
+
+    def test_fmt_hms(self):
+        """unittest function
+        """
+        self.assertEqual(_fmt_hms(0), "0:00:00")
+        self.assertEqual(_fmt_hms(3661), "1:01:01")
+        # elapsed time of more than one day is reported in hours.
+        self.assertEqual(_fmt_hms(26 * 3600 + 3 * 60 + 4), "26:03:04")
 
 
 if __name__ == "__main__":